@@ -1,12 +1,25 @@
 import streamlit as st
 import os
+import shutil
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
 from controls import *
 import logging
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Bank and lending statement columns displayed as currency, printf style for st.column_config.
+# Streamlit 1.36 printf formats have no thousands separators, so tables show TSh 1000000.00
+# while format_currency totals show TSh 1,000,000.00
+AMOUNT_COLUMNS = ['Debit', 'Credit', 'debit', 'credit']
+AMOUNT_DISPLAY_FORMAT = 'TSh %.2f'
+
+# Bank and lending statement columns displayed as dates, momentjs style for st.column_config
+DATE_COLUMNS = ['Posting Date', 'Value Date', 'created_at']
+DATE_DISPLAY_FORMAT = 'DD.MM.YYYY'
+
 
 # Function to create directory if it doesn't exist
 def create_directory(directory):
@@ -16,9 +29,30 @@ def create_directory(directory):
 # Function to save uploaded file to specified directory
 def save_uploaded_file(uploaded_file, directory):
     create_directory(directory)
-    with open(os.path.join(directory, uploaded_file.name), "wb") as f:
-        f.write(uploaded_file.getbuffer())
-    return os.path.join(directory, uploaded_file.name)
+    file_path = os.path.join(directory, uploaded_file.name)
+    # Streamlit reruns the script on every interaction, rewriting the same upload would change
+    # its modification time and invalidate the cached statements. Every new upload, even of a
+    # file with the same name and size, gets a new file_id
+    saved_uploads = st.session_state.setdefault('saved_uploads', {})
+    if saved_uploads.get(file_path) == uploaded_file.file_id and os.path.isfile(file_path):
+        return file_path
+    # Copy in 8 MiB blocks instead of materializing the whole upload at once
+    uploaded_file.seek(0)
+    with open(file_path, "wb") as f:
+        shutil.copyfileobj(uploaded_file, f, length=8 << 20)
+    saved_uploads[file_path] = uploaded_file.file_id
+    return file_path
+
+# Function to get the first file of a directory, if any
+def first_file(directory):
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    return entry.path
+    except FileNotFoundError:
+        pass
+    return None
 
 def display_metrics(title, stats):
     if title != "":
@@ -27,22 +61,82 @@ def display_metrics(title, stats):
     for col, (metric, value) in zip(cols, stats.items()):
         col.metric(metric, value)
 
-
-def process_large_csv(file_path, chunk_size=10000, needle=None):
-    """Read and process large CSV file in chunks."""
-    chunks = []
+def display_dataframe(df):
+    # Let the frontend format the amounts and dates instead of converting the columns to strings
+    column_config = {
+        column: st.column_config.NumberColumn(format=AMOUNT_DISPLAY_FORMAT)
+        for column in AMOUNT_COLUMNS if column in df.columns
+    }
+    column_config.update({
+        column: st.column_config.DatetimeColumn(format=DATE_DISPLAY_FORMAT)
+        for column in DATE_COLUMNS if column in df.columns
+    })
+    st.dataframe(df, column_config=column_config)
+
+
+def read_bank_csv(file_path, encoding, block_size, needle=None):
+    """Stream the bank statement CSV in blocks of strings, keeping only the rows whose details match the needle."""
+    read_options = pacsv.ReadOptions(block_size=block_size, encoding=encoding)
+
+    # Read every column as string, normalize_bank_data converts the ones it needs. The names come
+    # from Arrow itself, pandas renames blank and duplicate headers so they would not match
+    with pacsv.open_csv(file_path, read_options=read_options) as header_reader:
+        column_names = header_reader.schema.names
+    reader = pacsv.open_csv(
+        file_path,
+        read_options=read_options,
+        convert_options=pacsv.ConvertOptions(column_types={name: pa.string() for name in column_names}),
+    )
+
+    batches = []
+    for batch in reader:
+        if needle:
+            batch = batch.filter(details_contain(batch.column('Details'), needle))
+        batches.append(batch)
+    return pa.Table.from_batches(batches, schema=reader.schema)
+
+
+def process_large_csv(file_path, block_size=8 << 20, needle=None):
+    """Read and process large CSV file in blocks, filtering the rows before converting them to pandas."""
     try:
-        for chunk in pd.read_csv(file_path, chunksize=chunk_size, encoding='utf-8'):
-            chunk = normalize_bank_data(bank_df=chunk, needle=needle)
-            chunks.append(chunk)
-        return pd.concat(chunks, ignore_index=True)
-    except UnicodeDecodeError:
+        table = read_bank_csv(file_path, 'utf8', block_size, needle=needle)
+    except pa.ArrowInvalid as error:
+        # Any other parse or conversion error is not solved by another encoding
+        if 'invalid UTF8' not in str(error):
+            raise
         logger.error("Failed to decode file with utf-8 encoding, trying with latin encoding")
-        for chunk in pd.read_csv(file_path, chunksize=chunk_size, encoding='latin'):
-            chunk = normalize_bank_data(chunk, needle=needle)
-            chunks.append(chunk)
-            new_df = pd.concat(chunks, ignore_index=True)
-        return new_df
+        table = read_bank_csv(file_path, 'latin', block_size, needle=needle)
+    # Stitch the filtered batches into contiguous columns once, instead of one small chunk per block
+    bank_df = table.combine_chunks().to_pandas(types_mapper=pd.ArrowDtype)
+    return normalize_bank_data(bank_df, needle=needle)
+
+
+def file_signature(file_path):
+    """Modification time and size of a file, used to invalidate cached statements."""
+    return os.path.getmtime(file_path), os.path.getsize(file_path)
+
+
+@st.cache_data(show_spinner=False, max_entries=2)
+def load_bank_statement(file_path, signature, needle=None):
+    """Read and normalize the bank statement, cached until the file signature changes."""
+    # process_large_csv already normalizes every chunk
+    return process_large_csv(file_path, needle=needle)
+
+
+@st.cache_data(show_spinner=False, max_entries=2)
+def load_lender_statement(file_path, signature):
+    """Read and normalize the lending statement, cached until the file signature changes."""
+    lending_statement = pd.read_csv(file_path, engine='pyarrow')
+    lending_statement = normalize_lender_data(lending_statement)
+
+    # Fill NaN in ismatched with 'Not Checked', the few repeated values are stored as categories
+    try:
+        lending_statement['ismatched'] = lending_statement['ismatched'].fillna('Not Checked').astype('category')
+        lending_statement['POP'] = lending_statement['POP'].fillna('No PoP Provided').astype('category')
+    except KeyError:
+        logger.info("No ismatched or POP columns in lending statement")
+
+    return lending_statement
 
 
 def main():
@@ -54,44 +148,27 @@ def main():
     crdb_directory = "uploaded_files/crdb"
     lending_directory = "uploaded_files/lending"
 
-    # Check if files already exist
-    crdb_files = os.listdir(crdb_directory) if os.path.exists(crdb_directory) else []
-    lending_files = os.listdir(lending_directory) if os.path.exists(lending_directory) else []
-
-    # Initialize variables
-    crdb_file_path = None
-    lending_file_path = None
-
     # Sidebar with file upload widgets
     st.sidebar.title("Upload Files")
     crdb_file = st.sidebar.file_uploader("Upload CRDB Bank Statement CSV", type="csv")
     lending_file = st.sidebar.file_uploader("Upload Lending Company Payment Document CSV", type="csv")
 
+    # Use the uploaded files, or the ones already saved
     if crdb_file:
         crdb_file_path = save_uploaded_file(crdb_file, crdb_directory)
-    elif crdb_files:
-        crdb_file_path = os.path.join(crdb_directory, crdb_files[0])
+    else:
+        crdb_file_path = first_file(crdb_directory)
 
     if lending_file:
         lending_file_path = save_uploaded_file(lending_file, lending_directory)
-    elif lending_files:
-        lending_file_path = os.path.join(lending_directory, lending_files[0])
+    else:
+        lending_file_path = first_file(lending_directory)
 
     # If files are available, process them
     if crdb_file_path and lending_file_path:
-        bank_statement = process_large_csv(crdb_file_path, needle="ramani")
-        lending_statement = pd.read_csv(lending_file_path)
-
-        # Normalize data
-        bank_statement = normalize_bank_data(bank_statement)
-        lending_statement = normalize_lender_data(lending_statement)
-
-        # Fill NaN in ismatched with 'Not Checked'
-        try:
-            lending_statement['ismatched'] = lending_statement['ismatched'].fillna('Not Checked')
-            lending_statement['POP'] = lending_statement['POP'].fillna('No PoP Provided')
-        except KeyError:
-            logger.info("No ismatched or POP columns in lending statement")
+        # Load and normalize data, reruns reuse the cached statements
+        bank_statement = load_bank_statement(crdb_file_path, file_signature(crdb_file_path), needle="ramani")
+        lending_statement = load_lender_statement(lending_file_path, file_signature(lending_file_path))
 
         # Get File stats
         bank_stats, bank_credit_debit = get_bank_stats(bank_statement)
@@ -109,18 +186,20 @@ def main():
         # check if there are missing PoPs
         if lender_stats['no_PoP'] > 0:
             st.subheader("🧾 Records missing Proof of Payment (airtable):")
-            st.write(get_lender_df_by_column_and_value('POP', 'No PoP Provided', lending_statement))
+            missing_pop = get_lender_df_by_column_and_value('POP', 'No PoP Provided', lending_statement)
+            display_dataframe(missing_pop)
             # total missing value
-            total_missing_value = lending_statement[lending_statement['POP'] == 'No PoP Provided']['credit'].sum()
+            total_missing_value = missing_pop['credit'].sum()
             total_missing_value = format_currency(total_missing_value)
             st.write(f"Total Missing Value (sent to lender): {total_missing_value}")
 
         # check if there are unmatched records
         if lender_stats['unmatched'] > 0:
             st.subheader("❌ Unmatched Records (airtable):")
-            st.write(get_lender_df_by_column_and_value('ismatched', 'Not Checked', lending_statement))
+            unmatched = get_lender_df_by_column_and_value('ismatched', 'Not Checked', lending_statement)
+            display_dataframe(unmatched)
             # total unmatched value
-            total_unmatched_value = lending_statement[lending_statement['ismatched'] == 'Not Checked']['credit'].sum()
+            total_unmatched_value = unmatched['credit'].sum()
             total_unmatched_value = format_currency(total_unmatched_value)
             st.write(f"Total Unmatched Value: {total_unmatched_value}")
 
@@ -131,7 +210,7 @@ def main():
             # Display missing from lender
             st.subheader("⚠️ Records missing from Airtable:")
             st.write("Total Missing Records: ", len(missing_from_lender))
-            st.write(missing_from_lender.drop(columns=['normalized_description', 'Book Balance']))
+            display_dataframe(missing_from_lender.drop(columns=['normalized_description', 'Book Balance']))
 
             # total missing amount missing from lender
             total_missing_amount = missing_from_lender['Debit'].sum()
@@ -141,7 +220,7 @@ def main():
             # matching records
             st.subheader("✅ Matching Records (bank statement & airtable):")
             st.write("Total Matching Records: ", len(matching_records))
-            st.write(matching_records)
+            display_dataframe(matching_records)
 
 
             st.write("---")
@@ -155,7 +234,7 @@ def main():
 
         st.write("---")
         st.subheader("All found transactions:")
-        st.write(bank_statement)
+        display_dataframe(bank_statement)
 
     else:
         st.info("Please upload both CSV files to start reconciliation.")
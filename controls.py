@@ -1,32 +1,101 @@
+import re
+import numpy as np
 import pandas as pd
+import pyarrow.compute as pc
 import string
 
+# Everything that is not a lower case ascii letter or digit, kept as a string because
+# Arrow backed string columns only take regex patterns as strings
+_NON_ALNUM_PATTERN = r'[^a-z0-9]+'
+
+# Dates are displayed as dd.mm.yyyy
+DATE_FORMAT = '%d.%m.%Y'
+
+# Currency symbol followed by the amount with commas as thousand separators and two decimal places
+CURRENCY_FORMAT = 'TSh {:,.2f}'
+
+
 def format_currency(value):
     """
     Format a number as a currency string with commas as thousand separators and the default currency symbol 'TSh'.
 
     Parameters:
-    value (float): The numeric value to be formatted.
+    value (float): The numeric value to be formatted. Missing values are formatted as zero.
 
     Returns:
     str: The formatted currency string.
     """
-    currency_symbol = 'TSh'
+    if pd.isna(value):
+        value = 0.0
+
+    return CURRENCY_FORMAT.format(value)
+
+
+def format_date(value):
+    """
+    Format a datetime as a day.month.year string.
+
+    Parameters:
+    value (pd.Timestamp): The datetime to be formatted.
+
+    Returns:
+    str: The formatted date string, empty for missing dates.
+    """
+    if pd.isna(value):
+        return ''
+
+    return value.strftime(DATE_FORMAT)
+
+
+def normalize_description(series):
+    """
+    Normalize a description column for matching.
+
+    Parameters:
+    - series (pd.Series): The raw description column.
+
+    Returns:
+    - pd.Series: The descriptions in lower case, without punctuation marks and spaces.
+    """
+    series = series.astype('string[pyarrow]').str.lower()
+
+    return series.str.replace(_NON_ALNUM_PATTERN, '', regex=True).fillna('')
+
+
+def details_contain(details, needle):
+    """
+    Check which raw details contain the needle once normalized, without leaving Arrow.
+
+    Ascii details are matched with a single case-insensitive regex. Details with non ascii
+    characters are lower cased and stripped like normalize_description first, because the
+    regex does not fold case the same way as str.lower (e.g. 'İ').
 
-    # Format the number with commas as thousand separators and two decimal places
-    formatted_number = f"{value:,.2f}"
+    Parameters:
+    - details (pa.Array): The raw 'Details' column of a bank statement batch.
+    - needle (str): The normalized text to look for.
 
-    # Add the currency symbol
-    formatted_currency = f"{currency_symbol} {formatted_number}"
+    Returns:
+    - pa.BooleanArray: True where the normalized details contain the needle.
+    """
+    # Allow any characters the normalization removes between the needle letters, so the raw
+    # details are scanned once without building lower case and stripped copies of every row
+    pattern = '[^a-z0-9]*'.join(re.escape(char) for char in needle)
+    matches = pc.match_substring_regex(details, pattern, ignore_case=True)
 
-    return formatted_currency
+    # Redo the non ascii rows the exact way
+    non_ascii = pc.fill_null(pc.invert(pc.string_is_ascii(details)), False)
+    if pc.any(non_ascii).as_py():
+        normalized = pc.replace_substring_regex(pc.utf8_lower(details.filter(non_ascii)), _NON_ALNUM_PATTERN, '')
+        matches = pc.replace_with_mask(matches, non_ascii, pc.match_substring(normalized, needle))
+
+    return matches
 
 
 def normalize_lender_data(lender_df, needle=None):
     """
     Normalize the lender data in a DataFrame.
 
-    This function converts the 'created_at' column to a datetime format (day.month.year),
+    This function converts the 'created_at' column to datetimes,
     converts the 'credit' and 'debit' columns to numeric types, coercing any errors,
     and adds a 'normalized_description' column which is the 'description' column in
     lower case, without punctuation marks and spaces.
@@ -38,15 +107,15 @@ def normalize_lender_data(lender_df, needle=None):
     Returns:
     - pd.DataFrame: The normalized DataFrame with the specified columns converted.
     """
-    # Normalize 'created_at' date format to dd.mm.yyyy
-    lender_df['created_at'] = pd.to_datetime(lender_df['created_at']).dt.strftime('%d.%m.%Y')
+    # Convert 'created_at' to datetime, it is formatted as dd.mm.yyyy when displayed
+    lender_df['created_at'] = pd.to_datetime(lender_df['created_at'])
 
     # Convert 'credit' and 'debit' columns to numeric
     lender_df['credit'] = pd.to_numeric(lender_df['credit'], errors='coerce')
     lender_df['debit'] = pd.to_numeric(lender_df['debit'], errors='coerce')
 
     # Normalize 'description' column
-    lender_df['normalized_description'] = lender_df['description'].apply(lambda x: ''.join(e for e in x.lower() if e.isalnum()))
+    lender_df['normalized_description'] = normalize_description(lender_df['description'])
 
     return lender_df
 
@@ -56,7 +125,7 @@ def normalize_bank_data(bank_df, needle=None):
     """
     Normalize the bank data in a DataFrame.
 
-    This function converts the 'Posting Date' and 'Value Date' columns to a datetime format (day.month.year),
+    This function converts the 'Posting Date' and 'Value Date' columns to datetimes,
     converts the 'Debit' and 'Credit' columns to numeric types, coercing any errors,
     and adds a 'normalized_description' column which is the 'Details' column in
     lower case, without punctuation marks and spaces.
@@ -69,34 +138,46 @@ def normalize_bank_data(bank_df, needle=None):
     - pd.DataFrame: The normalized DataFrame with the specified columns converted.
     """
 
-    def parse_date(date_str):
-        # Attempt to parse the date string with the expected format
-        try:
-            return pd.to_datetime(date_str, format='%d.%m.%Y %H:%M:%S').strftime('%d.%m.%Y')
-        except ValueError:
-            # If parsing fails, try to parse it with a more flexible approach
-            try:
-                return pd.to_datetime(date_str, dayfirst=True).strftime('%d.%m.%Y')
-            except ValueError:
-                # If all parsing attempts fail, return the original string
-                return date_str
-
-    # Normalize 'Posting Date' and 'Value Date' date format to dd.mm.yyyy
-    bank_df['Posting Date'] = bank_df['Posting Date'].apply(parse_date)
-    bank_df['Value Date'] = bank_df['Value Date'].apply(parse_date)
-
-    # Ensure that 'Debit' and 'Credit' columns are strings
-    bank_df['Debit'] = bank_df['Debit'].astype(str).str.replace(',', '').astype(float)
-    bank_df['Credit'] = bank_df['Credit'].astype(str).str.replace(',', '').astype(float)
+    def parse_dates(dates):
+        # The reader may already have parsed the column
+        if pd.api.types.is_datetime64_any_dtype(dates):
+            return dates
+        # Parse the whole column with the expected format
+        parsed = pd.to_datetime(dates, format='%d.%m.%Y %H:%M:%S', errors='coerce')
+        failed = parsed.isna()
+        if failed.any():
+            # If parsing fails, try to parse the failed rows with a more flexible approach
+            parsed.loc[failed] = pd.to_datetime(dates[failed], dayfirst=True, format='mixed', errors='coerce')
+        # If all parsing attempts fail, the date is left as NaT
+        return parsed
+
+    def parse_amounts(amounts):
+        # The reader may already have converted the column
+        if pd.api.types.is_numeric_dtype(amounts):
+            return amounts.astype('float64')
+        # Strip the thousands separators before converting to float, coercing any errors
+        amounts = amounts.astype('string[pyarrow]').str.replace(',', '', regex=False)
+        return pd.to_numeric(amounts, errors='coerce').astype('float64')
+
+    # Convert 'Credit' first, it is needed to select the rows
+    bank_df['Credit'] = parse_amounts(bank_df['Credit'])
 
     # Normalizing other relevant columns if needed
     bank_df['Details'] = bank_df['Details'].astype(str)
 
     # Normalize 'Details' column
-    bank_df['normalized_description'] = bank_df['Details'].apply(lambda x: ''.join(e for e in x.lower() if e.isalnum()))
+    bank_df['normalized_description'] = normalize_description(bank_df['Details'])
 
+    # Drop the rows we are not looking for before doing the remaining work
     if needle:
-        return bank_df[bank_df['normalized_description'].str.contains(needle) & (bank_df['Credit'] == 0)]
+        mask = bank_df['normalized_description'].str.contains(needle, regex=False) & (bank_df['Credit'] == 0)
+        bank_df = bank_df.loc[mask].copy()
+
+    bank_df['Debit'] = parse_amounts(bank_df['Debit'])
+
+    # Convert 'Posting Date' and 'Value Date' to datetime, they are formatted as dd.mm.yyyy when displayed
+    bank_df['Posting Date'] = parse_dates(bank_df['Posting Date'])
+    bank_df['Value Date'] = parse_dates(bank_df['Value Date'])
 
     return bank_df
 
@@ -113,12 +194,15 @@ def get_lender_stats(lender_statement):
 
     # Total number of records
     results['records'] = len(lender_statement)
-    results['matched'] = len(lender_statement[lender_statement['ismatched'] == 'checked'])
-    results['unmatched'] = len(lender_statement[lender_statement['ismatched'] == 'Not Checked'])
-    results['PoP'] = len(lender_statement[lender_statement['POP'] != 'No PoP Provided'])
-    results['no_PoP'] = len(lender_statement[lender_statement['POP'] == 'No PoP Provided'])
-    total_credit = lender_statement[lender_statement['credit'].notnull()]['credit'].sum()
-    total_debit = lender_statement[lender_statement['debit'].notnull()]['debit'].sum()
+    # Count every status in a single pass per column
+    matched_counts = lender_statement['ismatched'].value_counts(dropna=False)
+    pop_counts = lender_statement['POP'].value_counts(dropna=False)
+    results['matched'] = int(matched_counts.get('checked', 0))
+    results['unmatched'] = int(matched_counts.get('Not Checked', 0))
+    no_pop = int(pop_counts.get('No PoP Provided', 0))
+    results['PoP'] = results['records'] - no_pop
+    results['no_PoP'] = no_pop
+    total_credit, total_debit = lender_statement[['credit', 'debit']].sum()
 
     # Format as currency
     credit_debit['credit_amount'] = format_currency(total_credit)
@@ -142,8 +226,8 @@ def get_bank_stats(bank_statement):
     total_debit = bank_statement['Debit'].sum()
 
     # Min - Max Posting Date
-    results['From'] = bank_statement['Posting Date'].iloc[0]
-    results['To'] = bank_statement['Posting Date'].iloc[-1]
+    results['From'] = format_date(bank_statement['Posting Date'].min())
+    results['To'] = format_date(bank_statement['Posting Date'].max())
 
     # Format as currency
     results['records'] = len(bank_statement)
@@ -164,14 +248,20 @@ def check_missing_from_lender(bank_statement, lender_statement):
 
     Returns:
     - pd.DataFrame: A DataFrame containing the records in the bank statement that are missing from the lender statement.
+    - pd.DataFrame: A DataFrame containing the records in the bank statement that are found in the lender statement.
     """
     # Get the normalized descriptions from both DataFrames
     bank_descriptions = bank_statement['normalized_description']
     lender_descriptions = lender_statement['normalized_description']
 
-    # Find the records in the bank statement that are missing from the lender statement
-    missing_records = bank_statement[~bank_descriptions.isin(lender_descriptions)]
-    matching_records = bank_statement[bank_descriptions.isin(lender_descriptions)]
+    # Factorize both sides together so the membership test compares integer codes
+    codes, _ = pd.factorize(pd.concat([bank_descriptions, lender_descriptions], ignore_index=True))
+    bank_codes, lender_codes = codes[:len(bank_descriptions)], codes[len(bank_descriptions):]
+    is_matching = np.isin(bank_codes, lender_codes)
+
+    # Split the bank statement into missing and matching records with the same mask
+    missing_records = bank_statement.loc[~is_matching]
+    matching_records = bank_statement.loc[is_matching]
 
     return missing_records, matching_records
 